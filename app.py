@@ -14,17 +14,26 @@
 #   - Двухшаговый seek для максимально точного кадр-старта
 
 import os
-import re
 import json
+import logging
+import time
+import errno
+import hashlib
+import asyncio
 import shutil
+import zipfile
 import tempfile
 import subprocess
+import uuid
+from collections import OrderedDict, deque
+from contextlib import aclosing, asynccontextmanager
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, Literal
+from typing import Callable, Optional, Literal
 
-import httpx
-from fastapi import FastAPI, HTTPException, Header, Request
-from fastapi.responses import FileResponse, JSONResponse
+import aiohttp
+from fastapi import FastAPI, HTTPException, Header, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field, HttpUrl
 from starlette.background import BackgroundTask
 
@@ -32,16 +41,179 @@ from starlette.background import BackgroundTask
 # ENV
 # -----------------------------
 API_KEY = (os.getenv("API_KEY") or "").strip()
+
+# uvicorn настраивает только свои логгеры — логгер сервиса (stderr ffmpeg и т.п.) поднимаем сами
+LOG_LEVEL = (os.getenv("LOG_LEVEL") or "INFO").strip().upper()
+log = logging.getLogger("ffmpeg-mix-service")
+if not log.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(levelname)s:     %(name)s: %(message)s"))
+    log.addHandler(_log_handler)
+    log.propagate = False
+log.setLevel(LOG_LEVEL)
+
 HTTP_TIMEOUT_SEC = int(os.getenv("HTTP_TIMEOUT_SEC") or "300")
 MAX_DOWNLOAD_MB = int(os.getenv("MAX_DOWNLOAD_MB") or "500")
+# Размер блока чтения из сети и записи на диск при скачивании
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
 TMP_PREFIX = os.getenv("TMP_PREFIX") or "ffmix_"
+# Временные файлы по возможности в RAM (tmpfs), если там хватает места — иначе обычный /tmp.
+# TMP_MIN_FREE_MB резервируется на каждый запрос в TMP_DIR; по умолчанию — худший случай /mix:
+# видео + музыка + голос по MAX_DOWNLOAD_MB и результат того же порядка
+TMP_DIR = os.getenv("TMP_DIR") or ("/dev/shm" if os.path.isdir("/dev/shm") else "")
+TMP_MIN_FREE_MB = int(os.getenv("TMP_MIN_FREE_MB") or str(MAX_DOWNLOAD_MB * 4))
+# tmpdir в TMP_DIR -> зарезервированные под него байты (снимается в _cleanup_dir)
+_TMP_RESERVED: dict[str, int] = {}
 FFMPEG_BIN = os.getenv("FFMPEG_BIN") or "ffmpeg"
 FFPROBE_BIN = os.getenv("FFPROBE_BIN") or "ffprobe"
 
+# По умолчанию классический MP4 с moov в начале (+faststart): его принимают все площадки.
+# Фрагментированный MP4 (+frag_keyframe+empty_moov+default_base_moof) обходится без второго
+# прохода, переписывающего файл, но часть ingest-пайплайнов его не берёт или видит длительность 0
+MP4_MOVFLAGS = os.getenv("MP4_MOVFLAGS") or "+faststart"
+
+# STREAM_OUTPUT=1: /mix и /clip отдают stdout ffmpeg сразу в ответ, без out.mp4 на диске.
+# Только для фрагментированного MP4 (empty_moov): +faststart требует seek по выходу.
+# Выключено по умолчанию: ответ идёт без Content-Length, ошибка ffmpeg посреди энкода —
+# это 200 и оборванное соединение, а не 500, и медленный клиент держит слот FFMPEG_SEM
+STREAM_OUTPUT = (os.getenv("STREAM_OUTPUT") or "0").strip() == "1"
+
+# Сколько ffmpeg-процессов (энкодов) одновременно; остальные ждут в очереди.
+# Каждый x264 держит сотни МБ буферов кадров и сам грузит все ядра.
+MAX_CONCURRENT_FFMPEG = int(os.getenv("MAX_CONCURRENT_FFMPEG") or str(max(1, (os.cpu_count() or 2) // 2)))
+FFMPEG_SEM = asyncio.Semaphore(MAX_CONCURRENT_FFMPEG)
+
+# Сколько последних строк stderr ffmpeg держать для текста ошибки
+FFMPEG_STDERR_LINES = 40
+
+# /mix?async=true: сколько хранить результат завершённой задачи, если его не забрали
+JOB_TTL_SEC = int(os.getenv("JOB_TTL_SEC") or "3600")
+# Сколько задач /mix?async=true может держать tmpdir одновременно — идущих и готовых, но ещё
+# не забранных: каждая сразу качает входы в tmpdir (семафор ждёт только ffmpeg), а готовая
+# держит out.mp4 до /result или JOB_TTL_SEC, так что без предела задачи забивают /dev/shm и память
+MAX_ASYNC_JOBS = int(os.getenv("MAX_ASYNC_JOBS") or str(MAX_CONCURRENT_FFMPEG * 2))
+
 # Хвост музыки/видео в конце /mix (всегда +1 сек по умолчанию)
 TAIL_MS = int(os.getenv("TAIL_MS") or "1000")
 
-app = FastAPI(title="ffmpeg-mix-service", version="1.2.0")
+# Музыку/голос /mix не класть на диск, а лить из сети прямо в ffmpeg через FIFO.
+# Только для потоковых форматов (mp3, aac/adts, wav, m4a с moov в начале).
+STREAM_AUDIO_INPUTS = (os.getenv("STREAM_AUDIO_INPUTS") or "0").strip() == "1"
+
+# Дисковый кэш скачанной музыки по sha256(URL): библиотека фоновых треков мала и
+# переиспользуется между запросами. CACHE_MAX_MB=0 отключает кэш.
+CACHE_DIR = Path(os.getenv("CACHE_DIR") or "/var/cache/ffmix")
+CACHE_MAX_MB = int(os.getenv("CACHE_MAX_MB") or "2048")
+# Раз в столько секунд запись кэша сверяется с источником (условный HEAD по ETag/Last-Modified)
+CACHE_REVALIDATE_SEC = int(os.getenv("CACHE_REVALIDATE_SEC") or "3600")
+# Файл кэша -> tmpdir запросов, чей ffmpeg читает его напрямую: пока tmpdir жив, не вытесняем
+_CACHE_USERS: dict[Path, set[str]] = {}
+
+# /clip и /clip_batch читают видео по URL прямо ffmpeg'ом, без предварительного скачивания:
+# при seek ffmpeg сам делает HTTP Range-запросы и тянет только нужные куски файла
+CLIP_REMOTE_INPUT = (os.getenv("CLIP_REMOTE_INPUT") or "1").strip() == "1"
+
+# Для удалённого входа разрешаем только сетевые протоколы (плейлисты не должны открыть file:)
+REMOTE_PROTOCOLS = "http,https,tcp,tls"
+# ...и только демуксеры одиночных файлов: HLS/DASH-плейлист прошёл бы HEAD-проверку размера,
+# а потом ffmpeg тянул бы сегменты с произвольных хостов в обход MAX_DOWNLOAD_MB
+REMOTE_FORMATS = "mov,mp4,m4a,3gp,3g2,mj2,matroska,webm"
+
+# Результаты ffprobe по (URL, ETag/Last-Modified): один и тот же исходник не пробуем повторно
+PROBE_CACHE_SIZE = int(os.getenv("PROBE_CACHE_SIZE") or "256")
+_PROBE_CACHE: OrderedDict[tuple[str, str], list[dict]] = OrderedDict()
+
+# /clip без перекодирования (-c copy), если start попадает в ключевой кадр с такой точностью
+COPY_KEYFRAME_TOLERANCE_MS = int(os.getenv("COPY_KEYFRAME_TOLERANCE_MS") or "10")
+
+# Потоки libx264: на многоядерных машинах дефолт ffmpeg переподписывает ядра
+# и упирается в блокировки. По умолчанию ядра делятся между MAX_CONCURRENT_FFMPEG энкодами.
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS") or str(max(2, (os.cpu_count() or 4) // MAX_CONCURRENT_FFMPEG)))
+
+# /clip_batch: фрагменты, между которыми меньше CLIP_BATCH_MAX_GAP_SEC, делят один декод;
+# дальше — отдельный запуск ffmpeg со своим seek (иначе декодируется весь промежуток).
+# Выходов на запуск не больше CLIP_BATCH_MAX_OUTPUTS: каждый запуск занимает один слот
+# FFMPEG_SEM, и потоки libx264 делятся между его энкодерами (NVENC на GeForce — до ~8 сессий)
+CLIP_BATCH_MAX_GAP_SEC = float(os.getenv("CLIP_BATCH_MAX_GAP_SEC") or "10")
+CLIP_BATCH_MAX_OUTPUTS = max(1, int(os.getenv("CLIP_BATCH_MAX_OUTPUTS") or "4"))
+
+# -tune для libx264 (по умолчанию нет). zerolatency убирает lookahead и B-кадры —
+# в 2-3 раза меньше буферов кадров на энкод ценой качества на тот же crf
+X264_TUNE = (os.getenv("X264_TUNE") or "").strip()
+
+# Аппаратное кодирование видео (/mix, /clip, /clip_batch): auto | nvenc | vaapi | videotoolbox | none
+HWACCEL = (os.getenv("HWACCEL") or "auto").strip().lower()
+VAAPI_DEVICE = os.getenv("VAAPI_DEVICE") or "/dev/dri/renderD128"
+
+# Фактически выбранный режим: определяется один раз при старте (см. lifespan)
+VIDEO_HWACCEL = "none"
+_FFMPEG_LISTS: dict[str, set[str]] = {}
+
+# Кодек исходника -> NVDEC-декодер, умеющий crop/resize прямо при декодировании
+CUVID_DECODERS = {
+    "h264": "h264_cuvid",
+    "hevc": "hevc_cuvid",
+    "vp9": "vp9_cuvid",
+    "av1": "av1_cuvid",
+}
+
+# Кодеки, которые VAAPI-драйверы Intel/AMD декодируют в железе
+VAAPI_DECODE_CODECS = {"h264", "hevc", "vp8", "vp9", "av1", "mpeg2video"}
+
+# Железные декодеры стабильно умеют только 8-битный 4:2:0 (10 бит и 4:2:2 у h264 — нет)
+GPU_DECODE_PIX_FMTS = {"yuv420p", "yuvj420p", "nv12"}
+
+# libx264 preset -> NVENC preset (p1 самый быстрый, p7 самый качественный)
+NVENC_PRESETS = {
+    "ultrafast": "p1",
+    "superfast": "p1",
+    "veryfast": "p2",
+    "faster": "p3",
+    "fast": "p4",
+    "medium": "p5",
+    "slow": "p6",
+    "slower": "p7",
+    "veryslow": "p7",
+}
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    global VIDEO_HWACCEL
+    _ffmpeg_list("encoders")  # прогрев: список энкодеров нужен и для выбора AAC-энкодера
+    _ffmpeg_list("decoders")
+    VIDEO_HWACCEL = _detect_hwaccel()
+
+    # Общая aiohttp-сессия на всё время жизни приложения: соединения к CDN переиспользуются
+    # между скачиваниями и запросами (без нового TCP+TLS на каждый URL).
+    # Таймауты — на connect/read, а не на всё скачивание целиком.
+    # keepalive дольше дефолтных 15 сек: соединение к CDN доживает до следующего запроса.
+    _app.state.http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=60),
+        timeout=aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=HTTP_TIMEOUT_SEC,
+            sock_read=HTTP_TIMEOUT_SEC,
+        ),
+    )
+    # Незабранные результаты удаляем по таймеру, а не только при следующих запросах к задачам
+    purge_task = asyncio.create_task(_purge_jobs_loop())
+    try:
+        yield
+    finally:
+        purge_task.cancel()
+        # Незавершённые задачи /mix?async=true отменяем, их tmpdir удаляем
+        for job in JOBS.values():
+            if job.task and not job.task.done():
+                job.task.cancel()
+        await asyncio.gather(*(job.task for job in JOBS.values() if job.task), return_exceptions=True)
+        for job in JOBS.values():
+            _cleanup_dir(job.tmpdir)
+        JOBS.clear()
+        await _app.state.http.close()
+
+
+app = FastAPI(title="ffmpeg-mix-service", version="1.2.0", lifespan=lifespan)
 
 
 # -----------------------------
@@ -64,6 +236,28 @@ class ClipRequest(BaseModel):
     start_ms: int = Field(..., ge=0, description="Start time in ms")
     end_ms: int = Field(..., ge=0, description="End time in ms")
 
+    out_w: int = Field(1080, ge=2, le=4096)
+    out_h: int = Field(1920, ge=2, le=4096)
+    # copy — без перекодирования, если исходник уже out_w×out_h (иначе как cover_center)
+    mode: Literal["cover_center", "copy"] = "cover_center"
+
+    crf: int = Field(20, ge=0, le=35)
+    preset: str = Field("veryfast")
+
+    # Начать клип с ближайшего ключевого кадра не позже start_ms: без точной доводки seek,
+    # а если исходник подходит под -c copy — вообще без энкода
+    snap_to_keyframe: bool = False
+
+
+class ClipSegment(BaseModel):
+    start_ms: int = Field(..., ge=0, description="Start time in ms")
+    end_ms: int = Field(..., ge=0, description="End time in ms")
+
+
+class ClipBatchRequest(BaseModel):
+    video_url: HttpUrl
+    segments: list[ClipSegment] = Field(..., min_length=1, max_length=32)
+
     out_w: int = Field(1080, ge=2, le=4096)
     out_h: int = Field(1920, ge=2, le=4096)
     mode: Literal["cover_center"] = "cover_center"
@@ -72,6 +266,52 @@ class ClipRequest(BaseModel):
     preset: str = Field("veryfast")
 
 
+# -----------------------------
+# Jobs (/mix?async=true)
+# -----------------------------
+@dataclass
+class MixJob:
+    tmpdir: str
+    total_s: float
+    status: Literal["running", "done", "failed"] = "running"
+    progress: float = 0.0
+    error: Optional[str] = None
+    finished_at: Optional[float] = None
+    task: Optional[asyncio.Task] = None
+
+
+# Задачи живут в памяти воркера: при WEB_CONCURRENCY > 1 /status и /result
+# должны попадать в тот же воркер, что и /mix
+JOBS: dict[str, MixJob] = {}
+
+
+# -----------------------------
+# Responses
+# -----------------------------
+class VideoFileResponse(FileResponse):
+    # Starlette отдаёт файл кусками по 64 КБ через anyio; для сотен МБ mp4 крупный кусок
+    # заметно сокращает число итераций event loop и syscall'ов на ответ.
+    # Сжатие mp4 бессмысленно — GZipMiddleware в приложении намеренно нет.
+    chunk_size = 1024 * 1024
+
+
+class FfmpegStreamResponse(StreamingResponse):
+    """
+    Тело — stdout уже запущенного ffmpeg. on_close вызывается всегда, даже если клиент
+    ушёл до первого байта и генератор тела так и не был запущен.
+    """
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self._on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self._on_close()
+
+
 # -----------------------------
 # Utils
 # -----------------------------
@@ -82,75 +322,1124 @@ def _check_api_key_value(x_api_key: Optional[str]) -> None:
         raise HTTPException(status_code=401, detail="Invalid X-API-Key")
 
 
-def _cleanup_dir(path: str) -> None:
-    shutil.rmtree(path, ignore_errors=True)
+def _dir_usage(path: str) -> int:
+    total = 0
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return total
+
+
+def _mkdtemp() -> str:
+    # Одного statvfs мало: параллельные запросы видят одно и то же свободное место и потом
+    # вместе упираются в ENOSPC. Поэтому из свободного вычитаем ещё не занятую часть
+    # резервов запросов, уже работающих в TMP_DIR (event loop один — гонки нет)
+    if TMP_DIR:
+        need = TMP_MIN_FREE_MB * 1024 * 1024
+        try:
+            st = os.statvfs(TMP_DIR)
+            pending = sum(max(0, size - _dir_usage(d)) for d, size in _TMP_RESERVED.items())
+            if st.f_bavail * st.f_frsize - pending >= need:
+                tmpdir = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=TMP_DIR)
+                _TMP_RESERVED[tmpdir] = need
+                return tmpdir
+        except OSError:
+            pass
+    return tempfile.mkdtemp(prefix=TMP_PREFIX)
 
 
-def _run(cmd: list[str]) -> None:
-    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if p.returncode != 0:
-        tail = (p.stderr or "")[-4000:]
-        raise HTTPException(status_code=500, detail=f"ffmpeg failed (code={p.returncode}): {tail}")
+def _cleanup_dir(path: str) -> None:
+    _TMP_RESERVED.pop(path, None)
+    # tmpdir запроса плоский: один scandir + unlink + rmdir вместо обхода rmtree со stat на файл.
+    # Повторный вызов (уже удалено) — не ошибка; что-то неожиданное внутри — добиваем rmtree
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+        os.rmdir(path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _keep_only(path: str, keep: str) -> None:
+    # Из tmpdir удаляем всё, кроме keep (входы и filters.txt после энкода не нужны),
+    # и снимаем резерв места под него — остаётся только результат
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name != keep:
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+    if path in _TMP_RESERVED:
+        _TMP_RESERVED[path] = 0
+
+
+async def _spawn_ffmpeg(cmd: list[str], stdout) -> asyncio.subprocess.Process:
+    # -loglevel error режет объём stderr у источника
+    return await asyncio.create_subprocess_exec(
+        cmd[0], "-loglevel", "error", *cmd[1:],
+        stdout=stdout,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+
+async def _read_stderr(proc: asyncio.subprocess.Process, tail: deque[str]) -> None:
+    # Построчно в лог (сразу, а не после энкода) и в кольцевой буфер для текста ошибки:
+    # в памяти не больше последних FFMPEG_STDERR_LINES строк, сколько бы ни шёл энкод
+    while True:
+        try:
+            line = await proc.stderr.readline()
+        except ValueError:
+            # строка длиннее лимита StreamReader — буфер уже сброшен, читаем дальше
+            continue
+        if not line:
+            return
+        text = line.decode(errors="replace")[:500]
+        log.info("ffmpeg[%d]: %s", proc.pid, text.rstrip())
+        tail.append(text)
+
+
+def _ffmpeg_error(returncode: Optional[int], tail: deque[str]) -> HTTPException:
+    return HTTPException(
+        status_code=500,
+        detail=f"ffmpeg failed (code={returncode}): {''.join(tail)}",
+    )
+
+
+async def _read_progress(proc: asyncio.subprocess.Process, on_progress: Callable[[float], None]) -> None:
+    # -progress pipe:1 — блоки строк key=value; out_time_us (и out_time_ms, тоже в мкс) —
+    # сколько секунд выхода уже записано
+    async for line in proc.stdout:
+        key, _, value = line.decode(errors="replace").strip().partition("=")
+        if key in ("out_time_us", "out_time_ms"):
+            try:
+                on_progress(int(value) / 1_000_000)
+            except ValueError:
+                pass  # N/A до первого кадра
+
+
+async def _run(cmd: list[str], on_progress: Optional[Callable[[float], None]] = None) -> None:
+    """
+    Запускает ffmpeg и ждёт завершения; 500 с хвостом stderr при ошибке.
+    on_progress получает секунды уже закодированного выхода (stdout занят под -progress).
+    """
+    # Не блокируем event loop на всё время энкода: остальные запросы обслуживаются параллельно.
+    tail: deque[str] = deque(maxlen=FFMPEG_STDERR_LINES)
+    stdout = asyncio.subprocess.DEVNULL
+    if on_progress:
+        cmd = [cmd[0], "-progress", "pipe:1", "-nostats", *cmd[1:]]
+        stdout = asyncio.subprocess.PIPE
+
+    # Энкоды упираются в CPU/GPU: сверх MAX_CONCURRENT_FFMPEG запуски ждут в очереди
+    async with FFMPEG_SEM:
+        proc = await _spawn_ffmpeg(cmd, stdout)
+        readers = [_read_stderr(proc, tail)]
+        if on_progress:
+            readers.append(_read_progress(proc, on_progress))
+        try:
+            await asyncio.gather(*readers, proc.wait())
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+
+    if proc.returncode != 0:
+        raise _ffmpeg_error(proc.returncode, tail)
 
 
 def _run_probe(cmd: list[str]) -> subprocess.CompletedProcess:
+    # Синхронный вариант — только для проверок при старте (lifespan)
     return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
 
 
-async def _download_to(path: Path, url: str) -> None:
+async def _run_probe_async(cmd: list[str]) -> tuple[int, str]:
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        stdout, _ = await proc.communicate()
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+    return proc.returncode, (stdout or b"").decode(errors="replace")
+
+
+def _validator(headers) -> Optional[str]:
+    # Версия содержимого по URL: ETag, иначе Last-Modified (None — версию не узнать)
+    return headers.get("ETag") or headers.get("Last-Modified")
+
+
+async def _check_remote_size(
+    url: str, client: aiohttp.ClientSession, max_bytes: int
+) -> tuple[Optional[str], int, bool]:
+    """
+    HEAD до скачивания: слишком большой файл отклоняем сразу, не тратя трафик.
+    Если HEAD не поддерживается или Content-Length нет — остаётся проверка по ходу скачивания.
+    Возвращает (ETag/Last-Modified, Content-Length или 0, есть ли Accept-Ranges: bytes).
+    """
+    try:
+        async with client.head(url, allow_redirects=True) as head:
+            if head.status >= 400:
+                return None, 0, False
+            validator = _validator(head.headers)
+            ranges = (head.headers.get("Accept-Ranges") or "").strip().lower() == "bytes"
+            size = int(head.headers.get("Content-Length") or 0)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        return None, 0, False
+    if size > max_bytes:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Download too large ({size // (1024 * 1024)} MB > {MAX_DOWNLOAD_MB} MB)",
+        )
+    return validator, size, ranges
+
+
+async def _iter_download(url: str, client: aiohttp.ClientSession, meta: Optional[dict] = None):
     max_bytes = MAX_DOWNLOAD_MB * 1024 * 1024
 
-    async with httpx.AsyncClient(follow_redirects=True, timeout=HTTP_TIMEOUT_SEC) as client:
-        r = await client.get(str(url))
+    await _check_remote_size(str(url), client, max_bytes)
+
+    # Range на байт больше лимита: сервер не отдаст лишнего, а превышение лимита
+    # всё равно видно счётчику ниже (ровно max_bytes + 1 байт — слишком большой файл)
+    async with client.get(str(url), headers={"Range": f"bytes=0-{max_bytes}"}) as r:
         r.raise_for_status()
+        if meta is not None:
+            meta["validator"] = _validator(r.headers)
+        # Content-Length ответа проверяем до чтения тела (HEAD мог быть не поддержан).
+        # На 206 полный размер — в Content-Range: "bytes 0-N/TOTAL"
+        size = r.content_length or 0
+        if r.status == 206:
+            try:
+                size = int(r.headers.get("Content-Range", "").rsplit("/", 1)[1])
+            except (IndexError, ValueError):
+                pass
+        if size > max_bytes:
+            raise HTTPException(status_code=413, detail="Download too large")
 
         total = 0
-        path.parent.mkdir(parents=True, exist_ok=True)
-        with path.open("wb") as f:
-            async for chunk in r.aiter_bytes(chunk_size=1024 * 256):
-                if not chunk:
-                    continue
-                total += len(chunk)
-                if total > max_bytes:
-                    raise HTTPException(status_code=413, detail="Download too large")
-                f.write(chunk)
-
-
-def _has_audio_stream(video_path: str) -> bool:
-    cmd = [
-        FFPROBE_BIN,
-        "-v", "error",
-        "-select_streams", "a:0",
-        "-show_entries", "stream=index",
-        "-of", "json",
-        video_path,
-    ]
-    p = _run_probe(cmd)
-    if p.returncode != 0:
+        async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK_BYTES):
+            if not chunk:
+                continue
+            total += len(chunk)
+            if total > max_bytes:
+                raise HTTPException(status_code=413, detail="Download too large")
+            yield chunk
+
+
+async def _download_to(path: Path, url: str, client: aiohttp.ClientSession) -> Optional[str]:
+    """Скачивает url в path; возвращает ETag/Last-Modified ответа (для кэша ffprobe)."""
+    # Запись — в потоке и крупными блоками: медленный диск не блокирует event loop,
+    # а накладные расходы Python/to_thread приходятся на мегабайт, а не на каждый сетевой кусок
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    # Файл пишется один раз подряд от начала до конца. DONTNEED после записи не делаем:
+    # ffmpeg читает его сразу следом, а страницы освобождаются при удалении tmpdir
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    meta: dict = {}
+    try:
+        buf = bytearray()
+        async with aclosing(_iter_download(url, client, meta)) as chunks:
+            async for chunk in chunks:
+                buf += chunk
+                if len(buf) >= DOWNLOAD_CHUNK_BYTES:
+                    await asyncio.to_thread(_write_all, fd, buf)
+                    buf.clear()
+        if buf:
+            await asyncio.to_thread(_write_all, fd, buf)
+    finally:
+        os.close(fd)
+    return meta.get("validator")
+
+
+def _link_or_copy(src: Path, dst: Path) -> None:
+    # Хардлинк без копирования данных; между разными ФС (например, tmpfs и диск) — копия
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _cache_in_use() -> set[Path]:
+    # Запрос закончился (tmpdir удалён) — его отметка снимается сама, без явного release
+    busy: set[Path] = set()
+    for cached, tmpdirs in list(_CACHE_USERS.items()):
+        alive = {d for d in tmpdirs if os.path.isdir(d)}
+        if alive:
+            _CACHE_USERS[cached] = alive
+            busy.add(cached)
+        else:
+            del _CACHE_USERS[cached]
+    return busy
+
+
+def _evict_cache(busy: set[Path]) -> None:
+    # Простейший LRU: удаляем самые давно использованные файлы, пока кэш больше лимита
+    max_bytes = CACHE_MAX_MB * 1024 * 1024
+    entries = []
+    total = 0
+    for p in CACHE_DIR.glob("*/*"):
+        # Только сами файлы: у .json (метаданные) и .part (недописанные) в имени есть точка
+        if "." in p.name or p in busy:
+            continue
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_atime, st.st_size, p))
+        total += st.st_size
+    entries.sort()
+    for _, size, p in entries:
+        if total <= max_bytes:
+            break
+        for f in (p, p.with_suffix(".json")):
+            try:
+                f.unlink()
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def _read_cache_meta(cached: Path) -> dict:
+    try:
+        return json.loads(cached.with_suffix(".json").read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache_meta(cached: Path, validator: Optional[str]) -> None:
+    meta = cached.with_name(f"{cached.name}.{os.urandom(4).hex()}.part")
+    meta.write_text(json.dumps({"validator": validator, "checked": time.time()}))
+    os.replace(meta, cached.with_suffix(".json"))
+
+
+async def _cache_is_fresh(cached: Path, url: str, client: aiohttp.ClientSession) -> bool:
+    meta = _read_cache_meta(cached)
+    if time.time() - float(meta.get("checked") or 0) < CACHE_REVALIDATE_SEC:
         return True
+    validator = meta.get("validator")
+    if not validator:
+        return False
+
+    # ETag всегда в кавычках (возможно, с W/), иначе это Last-Modified
+    if validator.startswith(('"', "W/")):
+        headers = {"If-None-Match": validator}
+    else:
+        headers = {"If-Modified-Since": validator}
+    try:
+        async with client.head(url, allow_redirects=True, headers=headers) as r:
+            # Часть CDN условные заголовки игнорирует — тогда сравниваем валидатор сами
+            fresh = r.status == 304 or (r.status < 400 and _validator(r.headers) == validator)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        # Источник недоступен — лучше отдать старую копию, чем уронить запрос
+        fresh = True
+
+    if fresh:
+        try:
+            _write_cache_meta(cached, validator)
+        except OSError:
+            pass
+    return fresh
+
+
+async def _download_cached(path: Path, url: str, client: aiohttp.ClientSession) -> Path:
+    """
+    Скачивает url в path через дисковый кэш; возвращает файл для -i ffmpeg.
+    При попадании это сам файл кэша: tmpdir обычно на tmpfs, кэш на диске, и хардлинк
+    между ними невозможен — копия в tmpdir стоила бы до MAX_DOWNLOAD_MB на каждый запрос.
+    """
+    if CACHE_MAX_MB <= 0:
+        await _download_to(path, url, client)
+        return path
+
+    key = hashlib.sha256(url.encode()).hexdigest()
+    cached = CACHE_DIR / key[:2] / key
+    if cached.exists() and await _cache_is_fresh(cached, url, client):
+        try:
+            # atime на relatime-маунтах не обновляется при чтении — отмечаем использование сами
+            os.utime(cached)
+            _CACHE_USERS.setdefault(cached, set()).add(str(path.parent))
+            return cached
+        except OSError:
+            pass
+
+    validator = await _download_to(path, url, client)
+
+    # Кэш — best effort: ошибка записи в него не должна ронять запрос.
+    # Копия tmpfs -> диск (хардлинк между ФС не выйдет) — в потоке, не блокируя event loop
+    try:
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        part = cached.with_name(f"{key}.{os.urandom(4).hex()}.part")
+        await asyncio.to_thread(_link_or_copy, path, part)
+        os.replace(part, cached)
+        _write_cache_meta(cached, validator)
+        await asyncio.to_thread(_evict_cache, _cache_in_use())
+    except OSError:
+        pass
+    return path
+
+
+async def _gather_or_cancel(*aws):
+    """
+    asyncio.gather, но при первой ошибке отменяет остальные задачи и дожидается их —
+    чтобы недокачанные файлы не писались в tmpdir, который уже удаляется.
+    """
+    tasks = [asyncio.ensure_future(a) for a in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def _write_all(fd: int, data: bytes | bytearray) -> None:
+    with memoryview(data) as view:
+        while view:
+            n = os.write(fd, view)
+            view = view[n:]
+
+
+async def _open_fifo_writer(fifo: Path, reader_done: asyncio.Event) -> Optional[int]:
+    # O_NONBLOCK-открытие на запись падает с ENXIO, пока ffmpeg не открыл FIFO на чтение.
+    # Опрашиваем, чтобы не зависнуть, если ffmpeg завершится раньше, чем дойдёт до этого входа.
+    while True:
+        try:
+            fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            if reader_done.is_set():
+                return None
+            await asyncio.sleep(0.02)
+            continue
+        os.set_blocking(fd, True)
+        return fd
+
+
+async def _stream_to_fifo(
+    fifo: Path, url: str, client: aiohttp.ClientSession, reader_done: asyncio.Event
+) -> None:
+    fd = await _open_fifo_writer(fifo, reader_done)
+    if fd is None:
+        return
+    try:
+        # aclosing: при EPIPE соединение закрывается сразу, а не при сборке мусора генератора
+        async with aclosing(_iter_download(url, client)) as chunks:
+            async for chunk in chunks:
+                await asyncio.to_thread(_write_all, fd, chunk)
+    except BrokenPipeError:
+        # ffmpeg закрыл вход (дочитал до -t или упал) — итог определяет его код возврата
+        pass
+    finally:
+        os.close(fd)
+
+
+async def _run_feeding(
+    cmd: list[str],
+    feeds: list[tuple[Path, str]],
+    client: aiohttp.ClientSession,
+    on_progress: Optional[Callable[[float], None]] = None,
+) -> None:
+    """Запускает ffmpeg, параллельно заливая скачиваемые входы в FIFO из feeds."""
+    if not feeds:
+        await _run(cmd, on_progress)
+        return
+
+    ffmpeg_done = asyncio.Event()
+
+    async def run_ffmpeg() -> None:
+        try:
+            await _run(cmd, on_progress)
+        finally:
+            ffmpeg_done.set()
+
+    results = await asyncio.gather(
+        run_ffmpeg(),
+        *(_stream_to_fifo(fifo, url, client, ffmpeg_done) for fifo, url in feeds),
+        return_exceptions=True,
+    )
+    # Ошибка скачивания важнее: ffmpeg мог успешно "доделать" ролик по обрезанному входу
+    for r in results[1:] + results[:1]:
+        if isinstance(r, BaseException):
+            raise r
+
+
+async def _stream_ffmpeg(
+    cmd: list[str], tmpdir: str, feeds: list[tuple[Path, str]], client: aiohttp.ClientSession
+) -> FfmpegStreamResponse:
+    """
+    Запускает ffmpeg с выходом в pipe:1 (и FIFO-входами из feeds) и отдаёт его stdout ответом.
+
+    Ответ начинается только с первым куском вывода: если ffmpeg падает раньше — это обычная
+    500 с хвостом stderr. Ошибка после начала отдачи обрывает соединение, а не «успешно»
+    дописывает обрезанный файл. tmpdir удаляется по завершении ответа.
+    """
+    tail: deque[str] = deque(maxlen=FFMPEG_STDERR_LINES)
+
+    # Слот семафора держим до конца отдачи: ffmpeg работает, пока клиент читает
+    await FFMPEG_SEM.acquire()
+    try:
+        proc = await _spawn_ffmpeg(cmd, asyncio.subprocess.PIPE)
+    except BaseException:
+        FFMPEG_SEM.release()
+        raise
+
+    ffmpeg_done = asyncio.Event()
+
+    async def wait_ffmpeg() -> None:
+        try:
+            await asyncio.gather(_read_stderr(proc, tail), proc.wait())
+        finally:
+            ffmpeg_done.set()
+
+    tasks = [
+        asyncio.ensure_future(wait_ffmpeg()),
+        *(asyncio.ensure_future(_stream_to_fifo(fifo, url, client, ffmpeg_done)) for fifo, url in feeds),
+    ]
+
+    async def finish() -> Optional[BaseException]:
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Ошибка скачивания важнее: ffmpeg мог успешно "доделать" ролик по обрезанному входу
+        for t in tasks[1:] + tasks[:1]:
+            if not t.cancelled() and t.exception() is not None:
+                return t.exception()
+        if proc.returncode != 0:
+            return _ffmpeg_error(proc.returncode, tail)
+        return None
+
+    closed = False
+
+    async def close() -> None:
+        nonlocal closed
+        if closed:
+            return
+        closed = True
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+        await asyncio.gather(*tasks, return_exceptions=True)
+        FFMPEG_SEM.release()
+        _cleanup_dir(tmpdir)
+
+    try:
+        first = await proc.stdout.read(VideoFileResponse.chunk_size)
+        if not first:
+            raise await finish() or HTTPException(status_code=500, detail="ffmpeg produced no output")
+    except BaseException:
+        await close()
+        raise
+
+    async def body():
+        yield first
+        while True:
+            chunk = await proc.stdout.read(VideoFileResponse.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        err = await finish()
+        if err is not None:
+            raise err
+
+    return FfmpegStreamResponse(
+        body(),
+        on_close=close,
+        media_type="video/mp4",
+        headers={"Content-Disposition": 'attachment; filename="out.mp4"'},
+    )
+
+
+def _streaming_output() -> bool:
+    return STREAM_OUTPUT and "empty_moov" in MP4_MOVFLAGS
+
+
+def _mp4_output(out_path: Path, to_pipe: Optional[bool] = None) -> list[str]:
+    """Хвост команды ffmpeg для выходного mp4: pipe:1 при STREAM_OUTPUT (или to_pipe), иначе файл."""
+    if _streaming_output() if to_pipe is None else to_pipe:
+        return ["-movflags", MP4_MOVFLAGS, "-f", "mp4", "pipe:1"]
+    return ["-movflags", MP4_MOVFLAGS, str(out_path)]
+
+
+async def _respond_mp4(
+    cmd: list[str],
+    tmpdir: str,
+    out_path: Path,
+    client: aiohttp.ClientSession,
+    feeds: Optional[list[tuple[Path, str]]] = None,
+):
+    """Выполняет команду, собранную с _mp4_output, и возвращает ответ с результатом."""
+    if _streaming_output():
+        return await _stream_ffmpeg(cmd, tmpdir, feeds or [], client)
+    await _run_feeding(cmd, feeds or [], client)
+    return VideoFileResponse(
+        str(out_path),
+        media_type="video/mp4",
+        filename="out.mp4",
+        background=BackgroundTask(_cleanup_dir, tmpdir),
+    )
+
+
+def _is_remote(path: str) -> bool:
+    return path.startswith(("http://", "https://"))
+
+
+def _remote_input_opts() -> list[str]:
+    """Опции ffmpeg перед -i для входа по URL с Range (переподключение при обрывах)."""
+    return [
+        "-protocol_whitelist", REMOTE_PROTOCOLS,
+        "-format_whitelist", REMOTE_FORMATS,
+        "-reconnect", "1",
+        "-reconnect_streamed", "1",
+        "-reconnect_delay_max", "5",
+        "-seekable", "1",
+    ]
+
+
+async def _probe_json(path: str, args: list[str]) -> dict:
+    remote = []
+    if _is_remote(path):
+        remote = ["-protocol_whitelist", REMOTE_PROTOCOLS, "-format_whitelist", REMOTE_FORMATS]
+    returncode, stdout = await _run_probe_async([FFPROBE_BIN, "-v", "error", *remote, *args, "-of", "json", path])
+    if returncode != 0:
+        return {}
     try:
-        data = json.loads(p.stdout or "{}")
-        return bool(data.get("streams"))
+        return json.loads(stdout or "{}")
     except Exception:
-        return True
+        return {}
+
+
+def _stream_rotation(stream: dict) -> int:
+    for sd in stream.get("side_data_list") or []:
+        if "rotation" in sd:
+            return int(float(sd["rotation"]))
+    return int(float((stream.get("tags") or {}).get("rotate") or 0))
+
+
+async def _probe_streams(path: str, url: Optional[str] = None, validator: Optional[str] = None) -> list[dict]:
+    """
+    Все нужные сервису поля потоков (кодек, размер, поворот, наличие аудио) одним ffprobe.
+    С url и validator (ETag/Last-Modified) результат кэшируется между запросами.
+    """
+    key = (url, validator) if url and validator else None
+    if key and key in _PROBE_CACHE:
+        _PROBE_CACHE.move_to_end(key)
+        return _PROBE_CACHE[key]
+
+    data = await _probe_json(path, [
+        "-show_entries",
+        "stream=codec_type,codec_name,width,height,pix_fmt,sample_aspect_ratio,start_time"
+        ":stream_tags=rotate:stream_side_data=rotation",
+    ])
+    streams = data.get("streams") or []
+
+    # Неудачную пробу не кэшируем
+    if key and streams:
+        _PROBE_CACHE[key] = streams
+        while len(_PROBE_CACHE) > PROBE_CACHE_SIZE:
+            _PROBE_CACHE.popitem(last=False)
+    return streams
+
+
+def _audio_codec(streams: list[dict]) -> Optional[str]:
+    a = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    return a.get("codec_name") if a else None
+
+
+def _video_size(streams: list[dict]) -> Optional[tuple[int, int]]:
+    v = next((s for s in streams if s.get("codec_type") == "video"), None)
+    if not v or _stream_rotation(v) % 360 != 0:
+        return None
+    return v.get("width"), v.get("height")
+
+
+async def _stream_copy_start(
+    video_path: str, streams: list[dict], req: "ClipRequest", start_s: float
+) -> Optional[float]:
+    """
+    Время ключевого кадра, с которого /clip можно отдать через -c copy, либо None.
+
+    Копирование даёт тот же результат, что и перекодирование, только если исходник
+    подходит (см. _copy_compatible), а start_ms совпадает с ключевым кадром.
+    """
+    if not _copy_compatible(streams, req):
+        return None
+
+    kf = await _nearest_keyframe(video_path, start_s, _start_time(streams))
+    if kf is None or abs(kf - start_s) * 1000.0 > COPY_KEYFRAME_TOLERANCE_MS:
+        return None
+    return kf
+
+
+def _copy_compatible(streams: list[dict], req: "ClipRequest") -> bool:
+    # H.264/yuv420p нужного размера без поворота и с квадратными пикселями, аудио AAC (или нет)
+    v = next((s for s in streams if s.get("codec_type") == "video"), None)
+    if not v:
+        return False
+    if (
+        v.get("codec_name") != "h264"
+        or v.get("pix_fmt") != "yuv420p"
+        or (v.get("width"), v.get("height")) != (req.out_w, req.out_h)
+        or v.get("sample_aspect_ratio") not in (None, "1:1", "0:1", "N/A")
+        or _stream_rotation(v) % 360 != 0
+    ):
+        return False
+    return _audio_codec(streams) in (None, "aac")
+
+
+def _start_time(streams: list[dict]) -> float:
+    # start_time файла (минимум по потокам): ffmpeg прибавляет его к входному -ss,
+    # а ffprobe отдаёт pts_time и читает -read_intervals в абсолютных таймстемпах
+    times = []
+    for s in streams:
+        try:
+            times.append(float(s["start_time"]))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return min(times, default=0.0)
+
+
+async def _keyframe_times(video_path: str, from_s: float, dur_s: float, offset_s: float) -> list[float]:
+    """
+    Ключевые кадры видео в окне [from_s, from_s + dur_s] — только пакеты, без декодирования.
+    Времена — от начала файла (абсолютный pts минус offset_s = start_time), как у -ss.
+    """
+    data = await _probe_json(video_path, [
+        "-select_streams", "v:0",
+        "-read_intervals", f"{max(0.0, from_s) + offset_s:.3f}%+{dur_s:.3f}",
+        "-show_entries", "packet=pts_time,flags",
+    ])
+    times = []
+    for pkt in data.get("packets") or []:
+        if "K" not in (pkt.get("flags") or ""):
+            continue
+        try:
+            times.append(float(pkt["pts_time"]) - offset_s)
+        except (KeyError, ValueError):
+            continue
+    return times
+
+
+async def _nearest_keyframe(video_path: str, t: float, offset_s: float) -> Optional[float]:
+    # Окно ±5 сек вокруг t
+    times = await _keyframe_times(video_path, t - 5.0, 10.0, offset_s)
+    return min(times, key=lambda pts: abs(pts - t), default=None)
+
+
+async def _prior_keyframe(video_path: str, t: float, offset_s: float) -> Optional[float]:
+    # Последний ключевой кадр не позже t (GOP длиннее 10 сек — None)
+    times = await _keyframe_times(video_path, t - 10.0, min(t, 10.0) + 0.001, offset_s)
+    return max((pts for pts in times if pts <= t + 0.0005), default=None)
+
+
+def _audio_codec_args() -> list[str]:
+    # libfdk_aac быстрее и качественнее встроенного aac, но есть только в nonfree-сборках ffmpeg
+    if "libfdk_aac" in _ffmpeg_list("encoders"):
+        return ["-c:a", "libfdk_aac", "-b:a", "192k"]
+    return ["-c:a", "aac", "-b:a", "192k"]
+
+
+def _ffmpeg_list(kind: str) -> set[str]:
+    """Имена из `ffmpeg -encoders` / `ffmpeg -filters` (мемоизируется)."""
+    if kind in _FFMPEG_LISTS:
+        return _FFMPEG_LISTS[kind]
+    names: set[str] = set()
+    try:
+        p = _run_probe([FFMPEG_BIN, "-hide_banner", f"-{kind}"])
+        if p.returncode == 0:
+            for line in (p.stdout or "").splitlines():
+                parts = line.split()
+                if len(parts) >= 2:
+                    names.add(parts[1])
+    except OSError:
+        pass
+    _FFMPEG_LISTS[kind] = names
+    return names
+
+
+def _encoder_works(hwaccel: str) -> bool:
+    # Энкодер в `ffmpeg -encoders` ещё не значит, что есть GPU (в сборках Debian
+    # h264_nvenc/h264_vaapi вкомпилированы всегда), поэтому делаем пробный энкод —
+    # ровно с теми опциями, что и реальные /mix и /clip (h264_videotoolbox на Intel Mac,
+    # например, отвергает -q:v)
+    pre_input, vf_tail, video_codec = _video_encoder_args(20, "veryfast", hwaccel)
+    if video_codec[video_codec.index("-c:v") + 1] not in _ffmpeg_list("encoders"):
+        return False
+    try:
+        p = _run_probe([
+            FFMPEG_BIN,
+            "-hide_banner",
+            "-loglevel", "error",
+            *pre_input,
+            "-f", "lavfi",
+            "-i", "color=c=black:s=256x256:d=0.1",
+            "-vf", "format=yuv420p" + vf_tail,
+            *video_codec,
+            "-f", "null",
+            "-",
+        ])
+    except OSError:
+        return False
+    return p.returncode == 0
+
+
+def _detect_hwaccel() -> str:
+    wanted = HWACCEL if HWACCEL in ("auto", "nvenc", "vaapi", "videotoolbox", "none") else "auto"
+    for mode in ("nvenc", "vaapi", "videotoolbox"):
+        if wanted in ("auto", mode) and _encoder_works(mode):
+            return mode
+    return "none"
+
+
+def _video_encoder_args(
+    crf: int, preset: str, hwaccel: Optional[str] = None
+) -> tuple[list[str], str, list[str]]:
+    """
+    Видео-энкодер для кадров в обычной памяти (после CPU-фильтров):
+    (глобальные аргументы до входов, хвост для цепочки фильтров, аргументы энкодера).
+    hwaccel — режим вместо VIDEO_HWACCEL (для пробного энкода при старте).
+    """
+    hwaccel = hwaccel or VIDEO_HWACCEL
+    if hwaccel == "nvenc":
+        return [], "", [
+            "-c:v", "h264_nvenc",
+            "-preset", NVENC_PRESETS.get(preset, "p4"),
+            "-tune", "hq",
+            "-rc", "vbr",
+            "-cq", str(crf),
+            "-b:v", "0",
+            "-pix_fmt", "yuv420p",
+        ]
+    if hwaccel == "vaapi":
+        # h264_vaapi принимает только VAAPI-поверхности — загружаем кадры в конце графа
+        return ["-vaapi_device", VAAPI_DEVICE], ",format=nv12,hwupload", [
+            "-c:v", "h264_vaapi",
+            "-qp", str(crf),
+        ]
+    if hwaccel == "videotoolbox":
+        # -q:v (1..100, больше — лучше) — грубое соответствие crf 0..35
+        return [], "", [
+            "-c:v", "h264_videotoolbox",
+            "-q:v", str(max(1, 100 - 2 * crf)),
+            "-pix_fmt", "yuv420p",
+        ]
+    tune: list[str] = []
+    if X264_TUNE:
+        # Вдвое короче GOP (дефолт x264 keyint=250): seek по выходу не дорожает без lookahead
+        tune = ["-tune", X264_TUNE, "-g", "125"]
+    # Короткий lookahead и без sync-lookahead: меньше кадров в буферах на энкод, что под
+    # семафором важнее пары процентов битрейта. zerolatency всё это задаёт сам — не перебиваем
+    params = [] if "zerolatency" in X264_TUNE else [
+        "-x264-params", "sliced-threads=1:sync-lookahead=0:rc-lookahead=10",
+    ]
+    return [], "", [
+        "-c:v", "libx264",
+        "-preset", preset,
+        *tune,
+        "-threads", str(FFMPEG_THREADS),
+        *params,
+        "-crf", str(crf),
+        "-pix_fmt", "yuv420p",
+    ]
 
 
-def _sec(ms: int) -> float:
-    return ms / 1000.0
+def _gpu_decodable(streams: list[dict], codecs) -> Optional[dict]:
+    """
+    Видеопоток, если его можно декодировать и скейлить на GPU (кодек из codecs), иначе None.
+
+    Поворот и неквадратные пиксели декодер не учитывает: autorotate вставил бы CPU-transpose
+    перед scale_npp/scale_vaapi на аппаратных кадрах, и граф не собрался бы.
+    Если железо не берёт кодек, ffmpeg молча декодирует на CPU — кадры в обычной памяти
+    до scale_npp/scale_vaapi тоже не доходят. Такие исходники идут через CPU-фильтры.
+    """
+    v = next((s for s in streams if s.get("codec_type") == "video"), None)
+    if not v or (v.get("codec_name") or "") not in codecs:
+        return None
+    if v.get("pix_fmt") not in GPU_DECODE_PIX_FMTS:
+        return None
+    if _stream_rotation(v) % 360 != 0 or v.get("sample_aspect_ratio") not in (None, "1:1", "0:1", "N/A"):
+        return None
+    return v
+
+
+def _cuvid_cover_args(streams: list[dict], w: int, h: int) -> Optional[list[str]]:
+    """
+    Входные аргументы NVDEC (-c:v *_cuvid -crop -resize) для cover-кадрирования в w×h.
+
+    Декодер сам вырезает центральную область нужных пропорций и масштабирует её,
+    так что кадр от декода до NVENC не покидает VRAM. None — если исходник не подходит.
+    """
+    v = _gpu_decodable(streams, CUVID_DECODERS)
+    if not v:
+        return None
+    decoder = CUVID_DECODERS[v["codec_name"]]
+    if decoder not in _ffmpeg_list("decoders"):
+        return None
+    try:
+        src_w, src_h = int(v["width"]), int(v["height"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    # cover: масштаб max(w/W, h/H) => из исходника берём центр размера (w/s)×(h/s)
+    scale = max(w / src_w, h / src_h)
+    crop_w = min(src_w, int(round(w / scale / 2)) * 2)
+    crop_h = min(src_h, int(round(h / scale / 2)) * 2)
+    left = (src_w - crop_w) // 2
+    top = (src_h - crop_h) // 2
+    right = src_w - crop_w - left
+    bottom = src_h - crop_h - top
+
+    return [
+        "-hwaccel", "cuda",
+        "-hwaccel_output_format", "cuda",
+        "-c:v", decoder,
+        "-crop", f"{top}x{bottom}x{left}x{right}",
+        "-resize", f"{w}x{h}",
+    ]
 
 
-# -----------------------------
-# API
-# -----------------------------
-@app.get("/health")
-def health():
-    return {"ok": True, "service": "ffmpeg-mix-service"}
+def _clip_video_args(
+    req: "ClipRequest", streams: Optional[list[dict]] = None
+) -> tuple[list[str], str, list[str]]:
+    """Аргументы до -i, -vf и параметры видео-энкодера для /clip."""
+    w, h = req.out_w, req.out_h
+    pre, vf_tail, enc = _video_encoder_args(req.crf, req.preset)
+
+    if VIDEO_HWACCEL == "nvenc":
+        cuvid = _cuvid_cover_args(streams or [], w, h)
+        if cuvid:
+            # Кадры остаются CUDA-поверхностями вплоть до энкодера, поэтому без -pix_fmt:
+            # NVENC сам кодирует nv12 в 4:2:0
+            return cuvid, "setsar=1", [arg for arg in enc if arg not in ("-pix_fmt", "yuv420p")]
+        if "scale_npp" in _ffmpeg_list("filters") and _gpu_decodable(streams or [], CUVID_DECODERS):
+            # Декод (NVDEC) и scale (NPP) в VRAM; crop — CPU-фильтр,
+            # поэтому уже отскейленный кадр скачиваем в RAM только перед ним.
+            vf = (
+                f"scale_npp={w}:{h}:force_original_aspect_ratio=increase:format=nv12,"
+                f"hwdownload,format=nv12,"
+                f"crop={w}:{h},"
+                f"setsar=1"
+            )
+            return ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"], vf, enc
+
+    elif VIDEO_HWACCEL == "vaapi" and _gpu_decodable(streams or [], VAAPI_DECODE_CODECS):
+        # Декод и scale на VAAPI-поверхностях, crop на CPU, обратно hwupload под h264_vaapi.
+        vf = (
+            f"scale_vaapi=w={w}:h={h}:force_original_aspect_ratio=increase:format=nv12,"
+            f"hwdownload,format=nv12,"
+            f"crop={w}:{h},"
+            f"setsar=1,"
+            f"hwupload"
+        )
+        return [*pre, "-hwaccel", "vaapi", "-hwaccel_output_format", "vaapi"], vf, enc
+
+    vf = (
+        f"scale={w}:{h}:force_original_aspect_ratio=increase,"
+        f"crop={w}:{h},"
+        f"setsar=1"
+        f"{vf_tail}"
+    )
+    return pre, vf, enc
+
+
+async def _clip_source(
+    in_video: Path, url: str, client: aiohttp.ClientSession
+) -> tuple[str, list[str], list[dict]]:
+    """
+    Вход ffmpeg для /clip — сам URL (CLIP_REMOTE_INPUT) или скачанный файл —
+    опции перед его -i и потоки.
+    """
+    if CLIP_REMOTE_INPUT:
+        validator, size, ranges = await _check_remote_size(url, client, MAX_DOWNLOAD_MB * 1024 * 1024)
+        # По URL читаем, только если HEAD показал размер (он уже проверен против MAX_DOWNLOAD_MB —
+        # больше файла ffmpeg не вытянет) и поддержку Range (иначе каждый seek качает файл с начала).
+        # Иначе — обычное скачивание со счётчиком лимита.
+        if size and ranges:
+            return url, _remote_input_opts(), await _probe_streams(url, url, validator)
+    validator = await _download_to(in_video, url, client)
+    return str(in_video), [], await _probe_streams(str(in_video), url, validator)
+
+
+def _filter_script(path: Path, graph: str) -> str:
+    # Граф фильтров — файлом (-filter_complex_script / -filter_script:v), а не аргументом:
+    # с десятками фрагментов /clip_batch строка упирается в лимит длины одного аргумента execve
+    path.write_text(graph)
+    return str(path)
+
+
+def _clip_batch_groups(segments: list["ClipSegment"]) -> list[list[int]]:
+    """Индексы фрагментов, сгруппированные в запуски ffmpeg (по близости и CLIP_BATCH_MAX_OUTPUTS)."""
+    order = sorted(range(len(segments)), key=lambda i: segments[i].start_ms)
+    groups: list[list[int]] = []
+    group_end_ms = 0
+    for i in order:
+        seg = segments[i]
+        if (
+            not groups
+            or len(groups[-1]) >= CLIP_BATCH_MAX_OUTPUTS
+            or _sec(seg.start_ms - group_end_ms) > CLIP_BATCH_MAX_GAP_SEC
+        ):
+            groups.append([])
+            group_end_ms = 0
+        groups[-1].append(i)
+        group_end_ms = max(group_end_ms, seg.end_ms)
+    return groups
+
+
+def _clip_batch_cmd(
+    segments: list["ClipSegment"],
+    src: str,
+    in_opts: list[str],
+    has_audio: bool,
+    clip_args: tuple[list[str], str, list[str]],
+    script: Path,
+    out_paths: list[Path],
+) -> list[str]:
+    """Команда ffmpeg для группы /clip_batch: один seek к группе, split/trim по фрагментам."""
+    pre_input, vf, video_codec = clip_args
+    n = len(segments)
+
+    # Один быстрый seek к самому раннему фрагменту группы; дальше границы задаёт trim.
+    # После входного -ss таймстемпы начинаются с 0 в точке fast_seek_s.
+    fast_seek_s = max(0.0, _sec(min(seg.start_ms for seg in segments)) - 2.0)
+    read_s = _sec(max(seg.end_ms for seg in segments)) - fast_seek_s
+
+    # trim до scale: кадры вне фрагментов отбрасываются до дорогого масштабирования
+    graph = ["[0:v]split=" + str(n) + "".join(f"[s{i}]" for i in range(n))]
+    if has_audio:
+        graph.append("[0:a]asplit=" + str(n) + "".join(f"[as{i}]" for i in range(n)))
+    for i, seg in enumerate(segments):
+        a = _sec(seg.start_ms) - fast_seek_s
+        b = _sec(seg.end_ms) - fast_seek_s
+        graph.append(f"[s{i}]trim=start={a:.3f}:end={b:.3f},setpts=PTS-STARTPTS,{vf}[v{i}]")
+        if has_audio:
+            graph.append(f"[as{i}]atrim=start={a:.3f}:end={b:.3f},asetpts=PTS-STARTPTS[a{i}]")
+
+    # Энкодеры группы делят потоки одного слота FFMPEG_SEM
+    video_codec = list(video_codec)
+    if "-threads" in video_codec:
+        video_codec[video_codec.index("-threads") + 1] = str(max(1, FFMPEG_THREADS // n))
+
+    cmd = [
+        FFMPEG_BIN,
+        "-hide_banner",
+        "-y",
+        *pre_input,
+        "-ss", f"{fast_seek_s:.3f}",
+        "-t", f"{read_s:.3f}",
+        *in_opts,
+        "-i", src,
+        "-filter_complex_script", _filter_script(script, ";".join(graph)),
+    ]
+    for i, out in enumerate(out_paths):
+        cmd += ["-map", f"[v{i}]"]
+        if has_audio:
+            cmd += ["-map", f"[a{i}]", *_audio_codec_args()]
+        cmd += [*video_codec, "-movflags", MP4_MOVFLAGS, str(out)]
+    return cmd
 
 
-@app.post("/mix")
-async def mix(req: MixRequest, x_api_key: Optional[str] = Header(default=None, alias="X-API-Key")):
-    _check_api_key_value(x_api_key)
+def _zip_files(zip_path: Path, files: list[Path]) -> None:
+    # mp4 уже сжат — ZIP_STORED, без лишней траты CPU на deflate
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_STORED) as zf:
+        for f in files:
+            zf.write(f, arcname=f.name)
+
+
+def _mix_graph(req: "MixRequest", base_s: float, tail_s: float, second: Optional[str], vf_tail: str) -> str:
+    """
+    filter_complex для /mix с выходами [vout] и [aout].
+
+    second — вторая дорожка под музыку: "voice" (вход 2), "video" (аудио из входа 0) или None.
+    """
+    total_s = base_s + tail_s
+    # Музыку и видео фейдим ровно на хвосте: fade start = base_s (начало хвоста)
+    fade_start_s = base_s
+    fade_dur_s = tail_s
+
+    # Видео: режем до base_s, добавляем хвост (clone last frame) и фейдим хвост в чёрный
+    # tpad stop_duration = tail_s (если tail_s=0, то tpad ничего не добавит).
+    # Из-за tpad/fade видео здесь всегда перекодируется: пути -c:v copy / ремукса в /mix нет.
+    v_filter = (
+        f"[0:v]trim=0:{base_s:.3f},setpts=PTS-STARTPTS,"
+        f"tpad=stop_mode=clone:stop_duration={tail_s:.3f},"
+        f"fade=t=out:st={fade_start_s:.3f}:d={fade_dur_s:.3f}{vf_tail}[vout]"
+    )
+
+    if second == "voice":
+        v_leg = f"[2:a]atrim=0:{base_s:.3f},volume={req.voice_volume}[v]"
+    elif second == "video":
+        v_leg = f"[0:a]atrim=0:{base_s:.3f}[v]"
+    else:
+        v_leg = ""
+
+    # Музыка: режем до total_s, фейдим на хвосте (последняя добавленная секунда).
+    # Без второй дорожки музыка сразу идёт на выход — без amix и лишнего atrim.
+    # -c:a copy тут невозможен: музыка всегда проходит volume/afade/atrim,
+    # да и исходник — произвольный mp3/m4a, а не готовый AAC-трек.
+    m_filter = (
+        f"[1:a]atrim=0:{total_s:.3f},"
+        f"volume={req.music_volume},"
+        f"afade=t=out:st={fade_start_s:.3f}:d={fade_dur_s:.3f}"
+        + ("[m]" if v_leg else "[aout]")
+    )
+
+    # atrim=0:x аудио от начала входа — asetpts после него не нужен. Обе дорожки уже обрезаны
+    # (музыка до total_s, голос до base_s), так что amix duration=longest не длиннее total_s
+    # и atrim после него лишний; жёсткий предел — внешний -t total_s. duration=first не берём:
+    # музыка короче ролика обрезала бы голос.
+    graph = [v_filter, m_filter]
+    if v_leg:
+        graph += [v_leg, "[m][v]amix=inputs=2:duration=longest:dropout_transition=0[aout]"]
+    return ";".join(graph)
+
+
+def _mix_cmd(
+    inputs: list[Path],
+    filter_complex: str,
+    total_s: float,
+    tmp: Path,
+    out_path: Path,
+    enc_pre: list[str],
+    video_codec: list[str],
+    to_pipe: Optional[bool] = None,
+) -> list[str]:
+    """Единственная команда ffmpeg /mix: сюда сходятся энкодер, граф фильтров и способ вывода."""
+    return [
+        FFMPEG_BIN,
+        "-hide_banner",
+        "-y",
+        *enc_pre,
+        *(arg for p in inputs for arg in ("-i", str(p))),
+        "-t", f"{total_s:.3f}",
+        "-filter_complex_script", _filter_script(tmp / "filters.txt", filter_complex),
+        "-map", "[vout]",
+        "-map", "[aout]",
+        *video_codec,
+        *_audio_codec_args(),
+        *_mp4_output(out_path, to_pipe),
+    ]
+
 
+def _mix_durations(req: "MixRequest") -> tuple[float, float, float]:
+    """(base_s, tail_s, total_s) для /mix."""
     # Базовая длительность (голос/основной фрагмент)
     base_s = max(_sec(int(req.duration_ms)), 0.001)
 
@@ -158,136 +1447,160 @@ async def mix(req: MixRequest, x_api_key: Optional[str] = Header(default=None, a
     tail_ms = max(int(TAIL_MS), 1)
     tail_s = max(_sec(tail_ms), 0.001)
 
-    total_s = max(base_s + tail_s, 0.001)
+    return base_s, tail_s, max(base_s + tail_s, 0.001)
 
-    # Музыку фейдим ровно на хвосте (последняя добавленная секунда)
-    # Важно: fade start = base_s (начало хвоста)
-    fade_start_s = base_s
-    fade_dur_s = tail_s
 
-    tmpdir = tempfile.mkdtemp(prefix=TMP_PREFIX)
-    tmp = Path(tmpdir)
+async def _prepare_mix(
+    req: "MixRequest", client: aiohttp.ClientSession, tmp: Path, to_pipe: Optional[bool] = None
+) -> tuple[list[str], list[tuple[Path, str]]]:
+    """Скачивает входы /mix в tmp и собирает команду ffmpeg; возвращает (cmd, FIFO-входы)."""
+    base_s, tail_s, total_s = _mix_durations(req)
 
     in_video = tmp / "input.mp4"
     in_music = tmp / "music.in"
     in_voice = tmp / "voice.in"
     out_path = tmp / "out.mp4"
 
+    # ffprobe видео запускаем сразу после его скачивания,
+    # не дожидаясь музыки/голоса — проба перекрывается с остальными загрузками
+    async def fetch_video() -> bool:
+        validator = await _download_to(in_video, str(req.video_url), client)
+        streams = await _probe_streams(str(in_video), str(req.video_url), validator)
+        return _audio_codec(streams) is not None
+
+    # Скачивания независимы — качаем параллельно.
+    # В режиме STREAM_AUDIO_INPUTS музыка/голос идут в ffmpeg через FIFO во время энкода,
+    # на диск заранее качаем только видео (ему нужен seek). Музыка при включённом кэше
+    # всегда идёт через кэш на диске.
+    feeds: list[tuple[Path, str]] = []
+    downloads = []
+    music_cached = not (STREAM_AUDIO_INPUTS and CACHE_MAX_MB <= 0)
+    if music_cached:
+        downloads.append(_download_cached(in_music, str(req.music_url), client))
+    else:
+        feeds.append((in_music, str(req.music_url)))
+    if req.voice_url:
+        if STREAM_AUDIO_INPUTS:
+            feeds.append((in_voice, str(req.voice_url)))
+        else:
+            downloads.append(_download_to(in_voice, str(req.voice_url), client))
+    for fifo, _ in feeds:
+        os.mkfifo(fifo)
+
+    video_has_audio, *fetched = await _gather_or_cancel(fetch_video(), *downloads)
+    if music_cached:
+        # Музыка из кэша читается ffmpeg'ом прямо из CACHE_DIR
+        in_music = fetched[0]
+
+    # Вторая дорожка под музыку: голос, иначе аудио из видео, иначе её нет
+    inputs = [in_video, in_music]
+    if req.voice_url:
+        inputs.append(in_voice)
+        second = "voice"
+    else:
+        second = "video" if video_has_audio else None
+
+    # Энкодер — libx264 или аппаратный (см. HWACCEL); фильтры видео всегда на CPU
+    enc_pre, enc_vf_tail, video_codec = _video_encoder_args(20, "veryfast")
+    filter_complex = _mix_graph(req, base_s, tail_s, second, enc_vf_tail)
+    cmd = _mix_cmd(inputs, filter_complex, total_s, tmp, out_path, enc_pre, video_codec, to_pipe)
+    return cmd, feeds
+
+
+async def _run_mix_job(job: MixJob, req: "MixRequest", client: aiohttp.ClientSession) -> None:
+    def on_progress(out_s: float) -> None:
+        job.progress = min(1.0, max(0.0, out_s / job.total_s))
+
     try:
-        await _download_to(in_video, str(req.video_url))
-        await _download_to(in_music, str(req.music_url))
-        if req.voice_url:
-            await _download_to(in_voice, str(req.voice_url))
-
-        video_has_audio = _has_audio_stream(str(in_video))
-
-        # Видео: режем до base_s, добавляем хвост (clone last frame) и фейдим хвост в чёрный
-        # tpad stop_duration = tail_s (если tail_s=0, то tpad ничего не добавит)
-        v_filter = (
-            f"[0:v]trim=0:{base_s:.3f},setpts=PTS-STARTPTS,"
-            f"tpad=stop_mode=clone:stop_duration={tail_s:.3f},"
-            f"fade=t=out:st={fade_start_s:.3f}:d={fade_dur_s:.3f}[vout]"
-        )
+        cmd, feeds = await _prepare_mix(req, client, Path(job.tmpdir), to_pipe=False)
+        await _run_feeding(cmd, feeds, client, on_progress)
+        _keep_only(job.tmpdir, "out.mp4")
+        job.status, job.progress = "done", 1.0
+    except asyncio.CancelledError:
+        job.status, job.error = "failed", "cancelled"
+        _cleanup_dir(job.tmpdir)
+        raise
+    except HTTPException as e:
+        job.status, job.error = "failed", str(e.detail)
+        _cleanup_dir(job.tmpdir)
+    except Exception as e:
+        job.status, job.error = "failed", f"Unhandled error: {e}"
+        _cleanup_dir(job.tmpdir)
+    finally:
+        job.finished_at = time.time()
+
+
+def _purge_jobs() -> None:
+    # Завершённые задачи, результат которых так и не забрали за JOB_TTL_SEC
+    now = time.time()
+    for job_id, job in list(JOBS.items()):
+        if job.finished_at is not None and now - job.finished_at > JOB_TTL_SEC:
+            del JOBS[job_id]
+            _cleanup_dir(job.tmpdir)
 
-        # Музыка: режем до total_s, фейдим на хвосте (последняя добавленная секунда)
-        m_filter = (
-            f"[1:a]atrim=0:{total_s:.3f},asetpts=PTS-STARTPTS,"
-            f"volume={req.music_volume},"
-            f"afade=t=out:st={fade_start_s:.3f}:d={fade_dur_s:.3f}[m]"
-        )
 
-        # Дальше собираем аудио в зависимости от наличия voice_url / аудио в видео
-        if req.voice_url:
-            a_filter = (
-                f"[2:a]atrim=0:{base_s:.3f},asetpts=PTS-STARTPTS,"
-                f"volume={req.voice_volume}[v];"
-                f"[m][v]amix=inputs=2:duration=longest:dropout_transition=0,"
-                f"atrim=0:{total_s:.3f}[aout]"
+async def _purge_jobs_loop() -> None:
+    while True:
+        await asyncio.sleep(min(60, max(1, JOB_TTL_SEC)))
+        _purge_jobs()
+
+
+def _get_job(job_id: str) -> MixJob:
+    _purge_jobs()
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+def _sec(ms: int) -> float:
+    return ms / 1000.0
+
+
+# -----------------------------
+# API
+# -----------------------------
+@app.get("/health")
+def health():
+    return {"ok": True, "service": "ffmpeg-mix-service"}
+
+
+@app.post("/mix")
+async def mix(
+    req: MixRequest,
+    request: Request,
+    async_: bool = Query(False, alias="async"),
+    x_api_key: Optional[str] = Header(default=None, alias="X-API-Key"),
+):
+    """
+    Микс музыки/голоса с видео. С ?async=true сразу отвечает 202 {"job_id": ...}:
+    прогресс — GET /status/{job_id}, готовый mp4 — GET /result/{job_id}.
+    """
+    _check_api_key_value(x_api_key)
+    client = request.app.state.http
+
+    if async_:
+        _purge_jobs()
+        # Готовые, но не забранные задачи тоже держат tmpdir (out.mp4) — считаем и их
+        if sum(job.status != "failed" for job in JOBS.values()) >= MAX_ASYNC_JOBS:
+            raise HTTPException(
+                status_code=503,
+                detail=f"Too many unfinished or unclaimed jobs (MAX_ASYNC_JOBS={MAX_ASYNC_JOBS}), retry later",
+                headers={"Retry-After": "30"},
             )
-            filter_complex = v_filter + ";" + m_filter + ";" + a_filter
+        job_id = uuid.uuid4().hex
+        job = MixJob(tmpdir=_mkdtemp(), total_s=_mix_durations(req)[2])
+        job.task = asyncio.create_task(_run_mix_job(job, req, client))
+        JOBS[job_id] = job
+        return JSONResponse(status_code=202, content={"job_id": job_id})
 
-            cmd = [
-                FFMPEG_BIN,
-                "-hide_banner",
-                "-y",
-                "-i", str(in_video),
-                "-i", str(in_music),
-                "-i", str(in_voice),
-                "-t", f"{total_s:.3f}",
-                "-filter_complex", filter_complex,
-                "-map", "[vout]",
-                "-map", "[aout]",
-                "-c:v", "libx264",
-                "-preset", "veryfast",
-                "-crf", "20",
-                "-pix_fmt", "yuv420p",
-                "-c:a", "aac",
-                "-b:a", "192k",
-                "-movflags", "+faststart",
-                str(out_path),
-            ]
-            _run(cmd)
+    tmpdir = _mkdtemp()
+    tmp = Path(tmpdir)
+    out_path = tmp / "out.mp4"
 
-        else:
-            if video_has_audio:
-                a_filter = (
-                    f"[0:a]atrim=0:{base_s:.3f},asetpts=PTS-STARTPTS[a0];"
-                    f"[a0][m]amix=inputs=2:duration=longest:dropout_transition=0,"
-                    f"atrim=0:{total_s:.3f}[aout]"
-                )
-                filter_complex = v_filter + ";" + m_filter + ";" + a_filter
-
-                cmd = [
-                    FFMPEG_BIN,
-                    "-hide_banner",
-                    "-y",
-                    "-i", str(in_video),
-                    "-i", str(in_music),
-                    "-t", f"{total_s:.3f}",
-                    "-filter_complex", filter_complex,
-                    "-map", "[vout]",
-                    "-map", "[aout]",
-                    "-c:v", "libx264",
-                    "-preset", "veryfast",
-                    "-crf", "20",
-                    "-pix_fmt", "yuv420p",
-                    "-c:a", "aac",
-                    "-b:a", "192k",
-                    "-movflags", "+faststart",
-                    str(out_path),
-                ]
-                _run(cmd)
-            else:
-                # В видео нет аудио: кладём только музыку как единственную дорожку
-                filter_complex = v_filter + ";" + m_filter + ";[m]atrim=0:{:.3f}[aout]".format(total_s)
-
-                cmd = [
-                    FFMPEG_BIN,
-                    "-hide_banner",
-                    "-y",
-                    "-i", str(in_video),
-                    "-i", str(in_music),
-                    "-t", f"{total_s:.3f}",
-                    "-filter_complex", filter_complex,
-                    "-map", "[vout]",
-                    "-map", "[aout]",
-                    "-c:v", "libx264",
-                    "-preset", "veryfast",
-                    "-crf", "20",
-                    "-pix_fmt", "yuv420p",
-                    "-c:a", "aac",
-                    "-b:a", "192k",
-                    "-movflags", "+faststart",
-                    str(out_path),
-                ]
-                _run(cmd)
-
-        return FileResponse(
-            str(out_path),
-            media_type="video/mp4",
-            filename="out.mp4",
-            background=BackgroundTask(_cleanup_dir, tmpdir),
-        )
+    try:
+        cmd, feeds = await _prepare_mix(req, client, tmp)
+        return await _respond_mp4(cmd, tmpdir, out_path, client, feeds)
 
     except HTTPException:
         _cleanup_dir(tmpdir)
@@ -297,68 +1610,196 @@ async def mix(req: MixRequest, x_api_key: Optional[str] = Header(default=None, a
         raise HTTPException(status_code=500, detail=f"Unhandled error: {e}")
 
 
+@app.get("/status/{job_id}")
+def status(job_id: str, x_api_key: Optional[str] = Header(default=None, alias="X-API-Key")):
+    _check_api_key_value(x_api_key)
+    job = _get_job(job_id)
+    return {
+        "job_id": job_id,
+        "status": job.status,
+        "progress": round(job.progress, 3),
+        "error": job.error,
+    }
+
+
+@app.get("/result/{job_id}")
+def result(job_id: str, x_api_key: Optional[str] = Header(default=None, alias="X-API-Key")):
+    _check_api_key_value(x_api_key)
+    job = _get_job(job_id)
+    if job.status == "running":
+        raise HTTPException(status_code=409, detail="Job is still running")
+    # Результат отдаётся один раз: задача снимается, tmpdir удаляется после отдачи
+    del JOBS[job_id]
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    return VideoFileResponse(
+        str(Path(job.tmpdir) / "out.mp4"),
+        media_type="video/mp4",
+        filename="out.mp4",
+        background=BackgroundTask(_cleanup_dir, job.tmpdir),
+    )
+
+
 @app.post("/clip")
-async def clip(req: ClipRequest, x_api_key: Optional[str] = Header(default=None, alias="X-API-Key")):
+async def clip(
+    req: ClipRequest,
+    request: Request,
+    x_api_key: Optional[str] = Header(default=None, alias="X-API-Key"),
+):
     _check_api_key_value(x_api_key)
+    client = request.app.state.http
 
     if req.end_ms <= req.start_ms:
         raise HTTPException(status_code=400, detail="end_ms must be > start_ms")
 
     start_s = _sec(req.start_ms)
-    dur_s = _sec(req.end_ms - req.start_ms)
+    end_s = _sec(req.end_ms)
+    dur_s = end_s - start_s
 
-    tmpdir = tempfile.mkdtemp(prefix=TMP_PREFIX)
+    tmpdir = _mkdtemp()
     tmp = Path(tmpdir)
 
     in_video = tmp / "input.mp4"
     out_path = tmp / "out.mp4"
 
     try:
-        await _download_to(in_video, str(req.video_url))
+        src, in_opts, streams = await _clip_source(in_video, str(req.video_url), client)
+
+        # Аудио /clip фильтрами не трогается: AAC просто копируем, остальное кодируем
+        audio_codec = ["-c:a", "copy"] if _audio_codec(streams) == "aac" else _audio_codec_args()
+
+        # Исходник уже в нужном формате и start на ключевом кадре — чистый ремукс без энкода.
+        # mode=copy: ремукс при совпадении размера даже без ключевого кадра на start —
+        # тогда клип начнётся с ближайшего ключевого кадра до start.
+        copy_start_s = await _stream_copy_start(src, streams, req, start_s)
+        if copy_start_s is None and req.mode == "copy" and _video_size(streams) == (req.out_w, req.out_h):
+            copy_start_s = start_s
+
+        # snap_to_keyframe: старт переносится на ключевой кадр до start, конец остаётся end_ms
+        snap_s: Optional[float] = None
+        if copy_start_s is None and req.snap_to_keyframe:
+            snap_s = await _prior_keyframe(src, start_s, _start_time(streams))
+            if snap_s is not None:
+                dur_s = end_s - snap_s
+                if _copy_compatible(streams, req):
+                    copy_start_s = snap_s
+
+        if copy_start_s is not None:
+            cmd = [
+                FFMPEG_BIN,
+                "-hide_banner",
+                "-y",
+                "-ss", f"{copy_start_s:.3f}",
+                *in_opts,
+                "-i", src,
+                "-t", f"{dur_s:.3f}",
+                "-map", "0:v:0",
+                "-map", "0:a?",
+                "-c:v", "copy",
+                *audio_codec,
+                "-avoid_negative_ts", "make_zero",
+                *_mp4_output(out_path),
+            ]
+            return await _respond_mp4(cmd, tmpdir, out_path, client)
 
         # Вертикальный Reels:
         # scale "cover" (increase) + crop по центру.
         # setsar=1 реально спасает от “сплюснуто” на части устройств/плееров (SAR может уехать).
-        if req.mode == "cover_center":
-            vf = (
-                f"scale={req.out_w}:{req.out_h}:force_original_aspect_ratio=increase,"
-                f"crop={req.out_w}:{req.out_h},"
-                f"setsar=1"
-            )
+        # При наличии NVENC/VAAPI кодируем на GPU (см. HWACCEL).
+        if req.mode in ("cover_center", "copy"):
+            pre_input, vf, video_codec = _clip_video_args(req, streams)
         else:
             raise HTTPException(status_code=400, detail=f"Unsupported mode: {req.mode}")
 
-        # Максимально точный кадр-старт: двухшаговый seek
-        fast_seek_s = max(0.0, start_s - 2.0)
-        accurate_seek_s = start_s - fast_seek_s
+        # Максимально точный кадр-старт: двухшаговый seek.
+        # Со snap_to_keyframe — только быстрый seek прямо на ключевой кадр, без доводки
+        if snap_s is not None:
+            fast_seek_s = snap_s
+            accurate_seek = []
+        else:
+            fast_seek_s = max(0.0, start_s - 2.0)
+            accurate_seek = ["-ss", f"{start_s - fast_seek_s:.3f}"]
 
         cmd = [
             FFMPEG_BIN,
             "-hide_banner",
             "-y",
+            *pre_input,
             "-ss", f"{fast_seek_s:.3f}",
-            "-i", str(in_video),
-            "-ss", f"{accurate_seek_s:.3f}",
+            *in_opts,
+            "-i", src,
+            *accurate_seek,
             "-t", f"{dur_s:.3f}",
-            "-vf", vf,
-            "-c:v", "libx264",
-            "-preset", req.preset,
-            "-crf", str(req.crf),
-            "-pix_fmt", "yuv420p",
+            "-filter_script:v", _filter_script(tmp / "filters.txt", vf),
+            *video_codec,
             "-map", "0:v:0",
             "-map", "0:a?",
-            "-c:a", "aac",
-            "-b:a", "192k",
-            "-movflags", "+faststart",
-            str(out_path),
+            *audio_codec,
+            *_mp4_output(out_path),
         ]
 
-        _run(cmd)
+        return await _respond_mp4(cmd, tmpdir, out_path, client)
+
+    except HTTPException:
+        _cleanup_dir(tmpdir)
+        raise
+    except Exception as e:
+        _cleanup_dir(tmpdir)
+        raise HTTPException(status_code=500, detail=f"Unhandled error: {e}")
+
+
+@app.post("/clip_batch")
+async def clip_batch(
+    req: ClipBatchRequest,
+    request: Request,
+    x_api_key: Optional[str] = Header(default=None, alias="X-API-Key"),
+):
+    """
+    Несколько клипов из одного видео: близкие фрагменты режутся одним запуском ffmpeg
+    (декод один раз, кадры раздаются через split/asplit), далёкие — отдельными запусками
+    со своим seek. Ответ — zip с clip_NN.mp4.
+    """
+    _check_api_key_value(x_api_key)
+    client = request.app.state.http
+
+    for seg in req.segments:
+        if seg.end_ms <= seg.start_ms:
+            raise HTTPException(status_code=400, detail="end_ms must be > start_ms")
+    if req.mode != "cover_center":
+        raise HTTPException(status_code=400, detail=f"Unsupported mode: {req.mode}")
+
+    tmpdir = _mkdtemp()
+    tmp = Path(tmpdir)
+
+    in_video = tmp / "input.mp4"
+    out_paths = [tmp / f"clip_{i:02d}.mp4" for i in range(len(req.segments))]
+    zip_path = tmp / "clips.zip"
 
-        return FileResponse(
-            str(out_path),
-            media_type="video/mp4",
-            filename="out.mp4",
+    try:
+        src, in_opts, streams = await _clip_source(in_video, str(req.video_url), client)
+        has_audio = _audio_codec(streams) is not None
+
+        clip_args = _clip_video_args(req, streams)
+
+        # Группы независимы и идут параллельно, каждая в своём слоте FFMPEG_SEM
+        await _gather_or_cancel(*(
+            _run(_clip_batch_cmd(
+                [req.segments[i] for i in group],
+                src,
+                in_opts,
+                has_audio,
+                clip_args,
+                tmp / f"filters_{k:02d}.txt",
+                [out_paths[i] for i in group],
+            ))
+            for k, group in enumerate(_clip_batch_groups(req.segments))
+        ))
+        await asyncio.to_thread(_zip_files, zip_path, out_paths)
+
+        return VideoFileResponse(
+            str(zip_path),
+            media_type="application/zip",
+            filename="clips.zip",
             background=BackgroundTask(_cleanup_dir, tmpdir),
         )
 
@@ -372,9 +1813,9 @@ async def clip(req: ClipRequest, x_api_key: Optional[str] = Header(default=None,
 
 @app.exception_handler(HTTPException)
 def http_exception_handler(_, exc: HTTPException):
-    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail}, headers=exc.headers)
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT") or "8010"))
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT") or "8010"), loop="uvloop", http="httptools")